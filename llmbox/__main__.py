@@ -5,16 +5,27 @@ import threading
 
 import httpx
 import ollama
-import sounddevice as sd  # type: ignore # noqa: F401
-import speech_recognition as sr
-from openai import AsyncOpenAI
+import sounddevice as sd  # type: ignore
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+try:
+    import uvloop
+
+    new_event_loop = uvloop.new_event_loop
+except ImportError:  # uvloop does not support Windows
+    new_event_loop = asyncio.new_event_loop
 
 from .llm_manager import LLMManager
 from .stt_manager import STTManager
 from .tts_manager import TTSManager
+from .utils import use_orjson_encoder
+from .vad_listener import VADListener
 
 logger: logging.Logger
 
+# Both backends are hit every turn, keep their connections open between turns
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=4, keepalive_expiry=900)
+
 
 __all__ = ["main"]
 
@@ -28,7 +39,7 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("-p", "--ollama-password", required=True)
     parser.add_argument("-v", "--verbose", action="store_true", default=False)
     parser.add_argument(
-        "--no-auto-calibrate", dest="auto_calibrate", action="store_false", default=True
+        "-d", "--device", type=int, default=None, help="Input device index"
     )
     parser.add_argument(
         "--task-expire-time", type=int, default=120, help="Task expire time in seconds"
@@ -59,26 +70,30 @@ def main(
     host: str,
     username: str,
     password: str,
-    auto_calibrate: bool,
     expire_time: int,
+    device: int | None = None,
 ):
     logger.info("Setting up llmbox...")
-    loop = asyncio.new_event_loop()
+    use_orjson_encoder()
+    loop = new_event_loop()
 
-    for index, name in enumerate(sr.Microphone.list_microphone_names()):
-        logging.info(
-            'Microphone with name "{1}" found for `Microphone(device_index={0})`'.format(
-                index, name
+    for index, info in enumerate(sd.query_devices()):
+        if info["max_input_channels"] > 0:
+            logging.info(
+                f'Microphone with name "{info["name"]}" found for `--device {index}`'
             )
-        )
-
-    recognizer = sr.Recognizer()
-    microphone = sr.Microphone()
 
-    openai_client = AsyncOpenAI(api_key=token, timeout=10, max_retries=3)
+    openai_client = AsyncOpenAI(
+        api_key=token,
+        timeout=10,
+        max_retries=3,
+        http_client=DefaultAsyncHttpxClient(http2=True, limits=HTTP_LIMITS),
+    )
     ollama_client = ollama.AsyncClient(
         host=host,
         auth=httpx.BasicAuth(username=username, password=password),
+        http2=True,
+        limits=HTTP_LIMITS,
     )
 
     speaker_lock = threading.Lock()
@@ -96,26 +111,19 @@ def main(
         flag="snakeCTF{llm_in_a_box_67}",
     )
     stt_manager = STTManager(
-        token=token, llm_manager=llm_manager, speaker_lock=speaker_lock
+        llm_manager=llm_manager,
+        tts_manager=tts_manager,
+        speaker_lock=speaker_lock,
     )
 
-    # Calibration
-    recognizer.energy_threshold = 4000
-    recognizer.pause_threshold = 2.2
-    recognizer.operation_timeout = 10
-    recognizer.phrase_threshold = 0.5
-    recognizer.non_speaking_duration = 0.8
-    if auto_calibrate:
-        logger.info("Calibrating microphone for ambient noise...")
-        with microphone as source:
-            recognizer.adjust_for_ambient_noise(source, duration=5)
-
     logger.info("Initializing...")
-    stopper = recognizer.listen_in_background(
-        microphone, callback=stt_manager.callback, phrase_time_limit=30
+    listener = VADListener(
+        callback=stt_manager.callback,
+        partial_callback=stt_manager.partial_callback,
+        phrase_time_limit=30,
+        device=device,
     )
-    tts_manager.run()
-    llm_manager.run()
+    listener.start()
 
     logger.info("llmbox is running. Press Ctrl+C to stop.")
 
@@ -125,7 +133,7 @@ def main(
         pass
 
     # Safely stop the background listener
-    stopper()
+    listener.stop()
     stt_manager.stop()
     llm_manager.stop()
     tts_manager.stop()
@@ -148,6 +156,6 @@ if __name__ == "__main__":
         username=args.ollama_username,
         password=args.ollama_password,
         host=args.ollama_server,
-        auto_calibrate=args.auto_calibrate,
         expire_time=args.task_expire_time,
+        device=args.device,
     )
@@ -1,11 +1,11 @@
 import asyncio
 import logging
+import re
 import string
-import threading
 import time
 from collections import deque
 from dataclasses import dataclass
-from typing import Deque, Final, Literal, Optional
+from typing import AsyncIterator, Coroutine, Deque, Final, Optional
 
 import ollama
 
@@ -18,32 +18,61 @@ __all__ = ["LLMManager", "LLMTask"]
 logger = logging.getLogger("llmbox.llm")
 ALLOWED_CHARACTERS = string.ascii_letters + string.digits + " .,?!{}-_"
 
-MODEL: Final[str] = "qwen3:1.7b"
+
+# Allowed characters are all ASCII, so filtering can run on bytes. Non-ASCII
+# characters are dropped by the encoding, the rest by bytes.translate
+_DELETE_BYTES: Final[bytes] = bytes(
+    b for b in range(128) if chr(b) not in ALLOWED_CHARACTERS
+)
+
+# Explicit 4-bit quantization tag, so a different default upstream does not slow decoding
+MODEL: Final[str] = "qwen3:1.7b-q4_K_M"
+KEEP_ALIVE: Final[str] = "15m"
+# Fixed context size, so Ollama does not reallocate the KV cache between calls
+CONTEXT_LENGTH: Final[int] = 2048
+
+CHAT_OPTIONS: Final[dict] = {
+    "seed": 42,
+    "temperature": 0.3,
+    "top_p": 0.95,
+    "top_k": 20,
+    # Replies are meant to be short, a spelled out flag still fits. No stop
+    # sequence, answers may follow a blank line and so does the end of a think block
+    "num_predict": 128,
+    "num_ctx": CONTEXT_LENGTH,
+}
+
+# End of a sentence in the streamed reply, where it can be handed over to TTS
+SENTENCE_END: Final = re.compile(r"[.!?]\s")
+
+# Partial transcripts shorter than this are too unstable to prefetch a reply for
+MIN_PREFETCH_WORDS: Final[int] = 3
 
 
 @dataclass
 class LLMTask:
-    receiving_time: int | float
     text: str
+    # time.monotonic() deadline, set when the task is added
+    expires_at: float = float("inf")
 
 
 @dataclass
-class Message:
+class Prefetch:
     text: str
-    role: Literal["user", "assistant"]
-
-    def to_openai_dict(self) -> dict:
-        return {"role": self.role, "content": self.text}
+    history: list[dict]
+    # Reply content as it is generated, then None, or the exception that stopped it
+    chunks: asyncio.Queue[str | Exception | None]
+    task: asyncio.Task
 
 
 class LLMManager:
     _client: ollama.AsyncClient
-    _queue: asyncio.Queue[LLMTask]
-    _queue_lock: threading.Lock
-
-    _message_history: Deque[Message]
+    _pending: Deque[LLMTask]
+    _asyncio_tasks: set[asyncio.Task]
+    _prefetch: Optional[Prefetch]
 
-    _asyncio_task: asyncio.Task
+    _system_prompt_msg: dict
+    _message_history: Deque[dict]
 
     def __init__(
         self,
@@ -56,43 +85,130 @@ class LLMManager:
         loop: Optional[asyncio.AbstractEventLoop] = None,
     ):
         self._flag = flag
+        self._system_prompt_msg = {
+            "role": "system",
+            "content": self._get_system_prompt(),
+        }
         self._client = client
         self._tts_manager = tts_manager
         self._task_expire_time = task_expire_time
         self._recollection_time = recollection_time
 
-        self._queue = asyncio.Queue()
-        self._queue_lock = threading.Lock()
+        self._pending = deque()
+        self._asyncio_tasks = set()
+        self._prefetch = None
 
         self._last_message_time = 0.0
         self._message_history_hash = random_string(10)
         self._message_history = deque(maxlen=max_message_history)
         self._message_task_lock = asyncio.Lock()
+        # Only one chat completion may be in flight at a time
+        self._chat_lock = asyncio.Lock()
 
         if loop is None:
             self._loop = asyncio.get_event_loop()
         else:
             self._loop = loop
 
-        self._loop.create_task(self._client.pull(MODEL))
-
-    def _has_expired(self, task: LLMTask) -> bool:
-        if self._task_expire_time == 0:
-            return False
-        # Expire if receiving_time + ttl is in the past
-        return (task.receiving_time + self._task_expire_time) < time.time()
+        self._create_task(self._warmup())
 
     def add_task(self, task: LLMTask) -> None:
-        # Thread-safe enqueue for asyncio.Queue
-        with self._queue_lock:
-            self._loop.call_soon_threadsafe(self._queue.put_nowait, task)
+        if self._task_expire_time != 0:
+            task.expires_at = time.monotonic() + self._task_expire_time
+        # Thread-safe scheduling from non-loop threads
+        self._loop.call_soon_threadsafe(self._schedule, task)
 
-    def run(self) -> None:
-        self._asyncio_task = self._loop.create_task(self._consume_tasks())
+    def prefetch(self, text: str) -> None:
+        # Thread-safe, start generating a reply to a partial transcript
+        self._loop.call_soon_threadsafe(self._start_prefetch, text)
 
     def stop(self) -> None:
-        if hasattr(self, "_asyncio_task"):
-            self._asyncio_task.cancel()
+        for asyncio_task in self._asyncio_tasks:
+            asyncio_task.cancel()
+
+    def _create_task(self, coro: Coroutine) -> asyncio.Task:
+        asyncio_task = self._loop.create_task(coro)
+        self._asyncio_tasks.add(asyncio_task)
+        asyncio_task.add_done_callback(self._asyncio_tasks.discard)
+        return asyncio_task
+
+    def _schedule(self, task: LLMTask) -> None:
+        self._pending.append(task)
+        self._create_task(self._handle())
+
+    def _start_prefetch(self, text: str) -> None:
+        # A turn in progress is about to change the history the reply depends on
+        if self._chat_lock.locked() or len(self._pending) > 0:
+            return
+        if len(text.split()) < MIN_PREFETCH_WORDS:
+            return
+
+        self._cancel_prefetch()
+        logger.debug(f"Prefetching reply for: {text}")
+
+        history = self._current_history()
+        chunks: asyncio.Queue[str | Exception | None] = asyncio.Queue()
+        messages = [*history, {"role": "user", "content": text}]
+        task = self._create_task(self._run_prefetch(messages, chunks))
+        self._prefetch = Prefetch(text=text, history=history, chunks=chunks, task=task)
+
+    async def _run_prefetch(
+        self, messages: list[dict], chunks: asyncio.Queue[str | Exception | None]
+    ) -> None:
+        try:
+            async for content in self._stream_reply(messages):
+                chunks.put_nowait(content)
+        except Exception as e:
+            chunks.put_nowait(e)
+            return
+        chunks.put_nowait(None)
+
+    def _cancel_prefetch(self) -> None:
+        if self._prefetch is not None:
+            self._prefetch.task.cancel()
+            self._prefetch = None
+
+    def _take_prefetch(self, text: str, history: list[dict]) -> Optional[Prefetch]:
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is None:
+            return None
+
+        if prefetch.history != history or not self._same_utterance(prefetch.text, text):
+            logger.debug("Prefetched reply does not match the final transcript")
+            prefetch.task.cancel()
+            return None
+        return prefetch
+
+    @staticmethod
+    def _same_utterance(a: str, b: str) -> bool:
+        # Partial and final transcripts may differ in casing and punctuation only
+        def normalize(text: str) -> str:
+            return "".join(c for c in text.casefold() if c.isalnum())
+
+        return normalize(a) == normalize(b)
+
+    @staticmethod
+    async def _drain_prefetch(prefetch: Prefetch) -> AsyncIterator[str]:
+        while (chunk := await prefetch.chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    async def _warmup(self) -> None:
+        # Load the model and prefill the system prompt before the first user turn
+        async with self._chat_lock:
+            try:
+                await self._client.pull(MODEL)
+                await self._client.chat(
+                    model=MODEL,
+                    messages=[self._system_prompt_msg],
+                    keep_alive=KEEP_ALIVE,
+                    think=False,
+                    options={**CHAT_OPTIONS, "num_predict": 1},
+                )
+                logger.info(f"Model {MODEL} loaded")
+            except Exception as e:
+                logger.exception("LLM warmup failed", exc_info=e)
 
     def _get_system_prompt(self) -> str:
         return (
@@ -109,23 +225,44 @@ class LLMManager:
 
     @staticmethod
     def _filter_letters(text: str) -> str:
-        return "".join([c for c in text if c in ALLOWED_CHARACTERS])
+        ascii_text = text.encode("ascii", "ignore")
+        return ascii_text.translate(None, _DELETE_BYTES).decode("ascii")
 
-    async def _consume_tasks(self) -> None:
+    async def _handle(self) -> None:
         try:
-            while True:
-                task = await self._queue.get()
+            # Run turns back to back, in order, so Ollama can reuse its KV cache
+            async with self._chat_lock:
+                task = self._merge_pending()
+                if task is None:
+                    return
 
-                if self._has_expired(task):
-                    logger.warning(
-                        f"Task expired, received_time: {task.receiving_time}"
-                    )
-                    continue
                 logger.debug(f"Received task: {task.text}")
-                self._loop.create_task(self._execute_task(task))
+                await self._execute_task(task)
         except asyncio.CancelledError:
-            logger.debug("LLM consume task cancelled")
-            return
+            logger.debug("LLM task cancelled")
+
+    def _merge_pending(self) -> Optional[LLMTask]:
+        # Coalesce the utterances received meanwhile into a single request
+        pending = list(self._pending)
+        self._pending.clear()
+
+        now = time.monotonic()
+        fresh = []
+        for t in pending:
+            if t.expires_at < now:
+                logger.warning(f"Task expired: {t.text}")
+                continue
+            fresh.append(t)
+
+        if len(fresh) == 0:
+            return None
+        if len(fresh) == 1:
+            return fresh[0]
+
+        return LLMTask(
+            text=" ".join(t.text for t in fresh),
+            expires_at=fresh[-1].expires_at,
+        )
 
     async def _reset_history(self):
         async with self._message_task_lock:
@@ -133,61 +270,88 @@ class LLMManager:
             self._last_message_time = 0.0
             self._message_history_hash = random_string(10)
 
+    def _history_expired(self) -> bool:
+        return time.time() - self._last_message_time > self._recollection_time
+
+    def _current_history(self) -> list[dict]:
+        # Messages a turn starting now would be sent before the user message
+        if self._history_expired():
+            return [self._system_prompt_msg]
+        return [self._system_prompt_msg, *self._message_history]
+
+    async def _stream_reply(self, messages: list[dict]) -> AsyncIterator[str]:
+        async for part in await self._client.chat(
+            model=MODEL,
+            messages=messages,  # type: ignore
+            stream=True,
+            keep_alive=KEEP_ALIVE,
+            think=False,
+            options=CHAT_OPTIONS,
+        ):
+            yield part.message.content or ""
+
     async def _execute_task(self, task: LLMTask) -> None:
         # Reset message history if we've been idle longer than recollection_time
-        if time.time() - self._last_message_time > self._recollection_time:
+        if self._history_expired():
             logger.info("Reset message history")
             await self._reset_history()
 
+        history = self._current_history()
+        prefetch = self._take_prefetch(task.text, history)
+
         # Add task to message history
-        user_message = Message(text=task.text, role="user")
+        user_message = {"role": "user", "content": task.text}
         async with self._message_task_lock:
             self._message_history.append(user_message)
 
-        messages = [{"role": "system", "content": self._get_system_prompt()}] + [
-            m.to_openai_dict() for m in self._message_history
-        ]
+        if prefetch is not None:
+            logger.info("Using prefetched LLM reply")
+            contents = self._drain_prefetch(prefetch)
+        else:
+            contents = self._stream_reply([*history, user_message])
 
+        spoken: list[str] = []
+        buffer = ""
         try:
-            reply = await self._client.chat(
-                model=MODEL,
-                messages=messages,  # type: ignore
-                keep_alive="15m",
-                think=True,
-                options={
-                    "seed": 42,
-                    "temperature": 0.8,
-                    "top_p": 0.95,
-                    "top_k": 20,
-                    "num_predict": 756,
-                },
-            )
+            async for content in contents:
+                buffer += content
+                # Reasoning is disabled, but drop a stray block if the model emits one
+                if "</think>" in buffer:
+                    buffer = buffer.split("</think>", 1)[-1]
+                elif "<think>" in buffer:
+                    continue
+
+                # Speak every complete sentence while the rest is still generating
+                while (match := SENTENCE_END.search(buffer)) is not None:
+                    self._speak(buffer[: match.end()], spoken)
+                    buffer = buffer[match.end() :]
         except Exception as e:
             logger.exception("LLM completion failed", exc_info=e)
             return
 
-        if reply is None:
-            logger.warning("LLM returned no reply. Resetting history.")
-            async with self._message_task_lock:
-                self._message_history.clear()
-            return
-
-        logger.debug(reply)
-        reply = reply.message.content.strip()
-        reply = reply.split("</think>", 1)[-1]
-
-        reply = self._filter_letters(reply)
-        if reply == "":
+        # A block still open at the end is reasoning cut off by the token limit
+        if "<think>" in buffer:
+            logger.warning("LLM reply ended inside a think block, dropping it")
+        else:
+            self._speak(buffer, spoken)
+        if len(spoken) == 0:
             logger.info("LLM response after filtering was empty")
             return
 
+        reply = " ".join(spoken)
         logger.info(f"LLM reply: {reply}")
 
         # Append assistant reply
-        assistant_message = Message(text=reply, role="assistant")
+        assistant_message = {"role": "assistant", "content": reply}
         async with self._message_task_lock:
             self._message_history.append(assistant_message)
         self._last_message_time = time.time()
 
-        # Send to TTS
-        self._tts_manager.add_task(TTSTask(receiving_time=time.time(), input=reply))
+    def _speak(self, text: str, spoken: list[str]) -> None:
+        text = self._filter_letters(text).strip()
+        if text == "":
+            return
+
+        logger.debug(f"Sending to TTS: {text}")
+        spoken.append(text)
+        self._tts_manager.add_task(TTSTask(input=text))
@@ -1,44 +1,73 @@
 import logging
-import os
 import threading
 import time
 from concurrent import futures
-from typing import Callable
+from dataclasses import dataclass
+from typing import Callable, Final, Optional
 
+import numpy as np
 import speech_recognition as sr
+from faster_whisper import WhisperModel
 
 from .llm_manager import LLMManager, LLMTask
+from .tts_manager import TTSManager
 
 __all__ = ["STTManager"]
 
 logger = logging.getLogger("llmbox.stt")
 
+# Audio device buffers keep playing for a moment after TTS releases the speaker
+SPEAKER_TAIL_TIME: Final[float] = 0.3
+
+# Recordings allowed to wait for (or be in) recognition before the oldest is dropped.
+# A queued partial is superseded by any newer recording, it never displaces a final
+MAX_PENDING_RECOGNITIONS: Final[int] = 2
+
+# Multilingual model, players are not required to speak English
+WHISPER_MODEL: Final[str] = "small"
+WHISPER_SAMPLE_RATE: Final[int] = 16000
+
+
+@dataclass
+class Recognition:
+    # Result is the transcript, or None if recognition failed
+    future: futures.Future
+    partial: bool
+
 
 class STTManager:
     _executor: futures.Executor
-    _token: str
+    # Recordings waiting for or in recognition
+    _pending: list[Recognition]
+    # Latest partial of the current phrase, its transcript may become the final one
+    _last_partial: Optional[Recognition]
+    _model: WhisperModel
     _llm_manager: LLMManager
+    _tts_manager: TTSManager
 
     def __init__(
         self,
-        token: str,
         llm_manager: LLMManager,
+        tts_manager: TTSManager,
         speaker_lock: threading.Lock,
         executor: futures.Executor | None = None,
     ):
-        self._token = token
         self._llm_manager = llm_manager
+        self._tts_manager = tts_manager
 
         # Speaker lock is assumed to be provided by caller
         self._speaker_lock = speaker_lock
 
-        # Speech recognition requires an API key in the environment variable
-        os.environ["OPENAI_API_KEY"] = token
+        # int8 quantized model running locally through CTranslate2
+        self._model = WhisperModel(WHISPER_MODEL, device="cpu", compute_type="int8")
 
         if executor is None:
-            self._executor = futures.ThreadPoolExecutor()
+            # A single worker keeps recognitions in order and one at a time
+            self._executor = futures.ThreadPoolExecutor(max_workers=1)
         else:
             self._executor = executor
+        self._pending = []
+        self._last_partial = None
 
     @staticmethod
     def _catch_all_executor(func: Callable, *args, **kwargs):
@@ -47,35 +76,128 @@ class STTManager:
         except Exception as e:
             logger.exception(msg="Error in STTManager ", exc_info=e)
 
-    def callback(self, recognizer: sr.Recognizer, audio: sr.AudioData):
+    def callback(self, audio: sr.AudioData, after_partial: bool = False):
+        last_partial, self._last_partial = self._last_partial, None
+        if self._overlaps_speaker(audio):
+            return
+
+        # Nothing was said since the partial, so its transcript is the final one
+        if after_partial and last_partial is not None:
+            if self._promote(last_partial):
+                return
+        self._submit(audio, partial=False)
+
+    def partial_callback(self, audio: sr.AudioData):
+        # Phrase so far, used to prefetch the LLM reply
+        self._last_partial = None
+        if self._overlaps_speaker(audio):
+            return
+        self._last_partial = self._submit(audio, partial=True)
+
+    def _promote(self, recognition: Recognition) -> bool:
+        if recognition.future.cancelled():
+            return False
+
+        logger.debug("Reusing the partial transcript as the final one")
+        # Counted as a final recording from now on, so it is not superseded
+        recognition.partial = False
+        recognition.future.add_done_callback(self._commit_promoted)
+        return True
+
+    def _commit_promoted(self, future: futures.Future):
+        # Dropping it from the backlog is already logged
+        if future.cancelled():
+            return
+        self._commit(future.result())
+
+    def _overlaps_speaker(self, audio: sr.AudioData) -> bool:
         # if TTS is speaking, skip recognition
         if self._speaker_lock.locked():
             logger.info("TTS is speaking, skipping STT recognition")
-            return
-
-        self._executor.submit(
-            self._catch_all_executor, self.recognize, recognizer, audio
+            return True
+
+        # if the phrase overlaps the end of the last playback, it likely caught TTS
+        duration = len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+        phrase_start = time.monotonic() - duration
+        if phrase_start < self._tts_manager.speaker_released_at + SPEAKER_TAIL_TIME:
+            logger.info("Audio overlaps TTS playback, skipping STT recognition")
+            return True
+
+        return False
+
+    def _submit(self, audio: sr.AudioData, partial: bool) -> Optional[Recognition]:
+        self._pending = [r for r in self._pending if not r.future.done()]
+
+        # Only the latest partial is useful, and none once the phrase has ended
+        for r in self._pending:
+            if r.partial and r.future.cancel():
+                logger.debug("Dropping an outdated partial recording")
+        self._pending = [r for r in self._pending if not r.future.done()]
+
+        # Keep the backlog bounded, dropping the oldest queued recordings first.
+        # Running recognitions cannot be cancelled, they still count towards the bound
+        while len(self._pending) >= MAX_PENDING_RECOGNITIONS:
+            # A partial never displaces a final recording
+            if partial:
+                logger.debug("STT backlog is full, skipping partial recording")
+                return None
+
+            queued = next((r for r in self._pending if not r.future.running()), None)
+            if queued is None:
+                logger.warning("STT backlog is full of running recognitions")
+                break
+            if queued.future.cancel():
+                logger.warning("STT backlog is full, dropping the oldest recording")
+            # It may also have started or finished meanwhile
+            if queued.future.done():
+                self._pending.remove(queued)
+
+        future = self._executor.submit(
+            self._catch_all_executor, self.recognize, audio, partial
         )
+        recognition = Recognition(future=future, partial=partial)
+        self._pending.append(recognition)
+        return recognition
 
     def stop(self, cancel_futures: bool = True):
         self._executor.shutdown(cancel_futures=cancel_futures)
 
-    def recognize(self, recognizer: sr.Recognizer, audio: sr.AudioData):
-        logger.info("Detected audio for STT recognition")
+    def recognize(self, audio: sr.AudioData, partial: bool = False) -> Optional[str]:
+        if partial:
+            logger.debug("Detected partial audio for STT recognition")
+        else:
+            logger.info("Detected audio for STT recognition")
+
+        raw = audio.get_raw_data(convert_rate=WHISPER_SAMPLE_RATE, convert_width=2)
+        samples = np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0
 
         try:
-            text: str = recognizer.recognize_openai(
-                audio_data=audio,
-                model="gpt-4o-mini-transcribe",
+            segments, _ = self._model.transcribe(
+                samples,
+                beam_size=1,
+                temperature=0,
+                vad_filter=False,
             )
+            text = "".join(segment.text for segment in segments)
         except Exception as e:
             logger.exception("STT recognition failed", exc_info=e)
-            return
+            return None
+
+        # Keep the original casing, the flag is case sensitive
+        text = text.strip().removesuffix(".")
+        if partial:
+            if text:
+                logger.debug(f"Recognized partial speech: {text}")
+                self._llm_manager.prefetch(text)
+            return text
+
+        self._commit(text)
+        return text
 
-        text = text.lower().strip().removesuffix(".")
-        if text is None or len(text) == 0:
+    def _commit(self, text: Optional[str]):
+        if not text:
             logger.info("No speech detected")
             return
 
         logger.info(f"Recognized speech: {text}")
-        self._llm_manager.add_task(LLMTask(receiving_time=time.time(), text=text))
+        self._llm_manager.add_task(LLMTask(text=text))
@@ -1,33 +1,49 @@
 import asyncio
 import logging
+import shutil
 import threading
 import time
+from asyncio import subprocess
 from dataclasses import dataclass
-from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import Optional
+from typing import AsyncIterator, Coroutine, Final, Optional
 
 from openai import AsyncOpenAI
-from playsound3 import playsound
 
 __all__ = ["TTSManager", "TTSTask"]
 
 
 logger = logging.getLogger("llmbox.tts")
 
+MODEL: Final[str] = "gpt-4o-mini-tts"
+VOICE: Final[str] = "alloy"
+
+# OpenAI "pcm" responses are raw 24kHz signed 16-bit little-endian mono samples
+PLAYER_COMMAND: Final[tuple[str, ...]] = (
+    "ffplay",
+    "-nodisp",
+    "-autoexit",
+    "-loglevel",
+    "error",
+    "-f",
+    "s16le",
+    "-ar",
+    "24000",
+    "-i",
+    "pipe:0",
+)
+STREAM_CHUNK_SIZE: Final[int] = 4096
+
 
 @dataclass
 class TTSTask:
-    receiving_time: int | float
     input: str
+    # time.monotonic() deadline, set when the task is added
+    expires_at: float = float("inf")
 
 
 class TTSManager:
     _client: AsyncOpenAI
-    _queue: asyncio.Queue[TTSTask]
-    _queue_lock: threading.Lock
-
-    _asyncio_task: asyncio.Task
+    _asyncio_tasks: set[asyncio.Task]
 
     def __init__(
         self,
@@ -36,91 +52,121 @@ class TTSManager:
         task_expire_time: int = 60,
         loop: Optional[asyncio.AbstractEventLoop] = None,
     ):
+        # Fail at startup rather than on every reply
+        if shutil.which(PLAYER_COMMAND[0]) is None:
+            raise RuntimeError(
+                f"{PLAYER_COMMAND[0]} not found, install FFmpeg to play TTS audio"
+            )
+
         self._task_expire_time = task_expire_time
         self._client = client
 
-        self._queue = asyncio.Queue()
-        self._queue_lock = threading.Lock()
+        self._asyncio_tasks = set()
+        # Segments are played one at a time, in the order they were produced
+        self._playback_lock = asyncio.Lock()
 
         self._speaker_lock = speaker_lock
+        self._speaker_released_at = 0.0
 
         if loop is None:
             self._loop = asyncio.get_event_loop()
         else:
             self._loop = loop
 
-    def _has_expired(self, task: TTSTask) -> bool:
-        if self._task_expire_time == 0:
-            return False
+        self._create_task(self._warmup())
 
-        # Expire if the task's receiving time plus TTL is in the past
-        return (task.receiving_time + self._task_expire_time) < time.time()
+    @property
+    def speaker_released_at(self) -> float:
+        # time.monotonic() of the last time playback ended
+        return self._speaker_released_at
 
     def add_task(self, task: TTSTask) -> None:
-        # Thread-safe enqueue for asyncio.Queue from non-loop threads
-        with self._queue_lock:
-            self._loop.call_soon_threadsafe(self._queue.put_nowait, task)
-
-    def run(self) -> None:
-        self._asyncio_task = self._loop.create_task(self._consume_tasks())
+        if self._task_expire_time != 0:
+            task.expires_at = time.monotonic() + self._task_expire_time
+        # Thread-safe scheduling from non-loop threads
+        self._loop.call_soon_threadsafe(self._schedule, task)
 
     def stop(self) -> None:
-        if hasattr(self, "_asyncio_task"):
-            self._asyncio_task.cancel()
-
-    async def _consume_tasks(self) -> None:
+        for asyncio_task in self._asyncio_tasks:
+            asyncio_task.cancel()
+
+    def _create_task(self, coro: Coroutine) -> None:
+        asyncio_task = self._loop.create_task(coro)
+        self._asyncio_tasks.add(asyncio_task)
+        asyncio_task.add_done_callback(self._asyncio_tasks.discard)
+
+    def _schedule(self, task: TTSTask) -> None:
+        self._create_task(self._handle(task))
+
+    async def _warmup(self) -> None:
+        # Open the connection to the speech endpoint before the first reply,
+        # the synthesized audio is discarded
+        async with self._playback_lock:
+            try:
+                async with self._client.audio.speech.with_streaming_response.create(
+                    model=MODEL,
+                    voice=VOICE,
+                    input=".",
+                    response_format="pcm",
+                    timeout=10,
+                ) as response:
+                    await response.read()
+            except Exception as e:
+                logger.exception("TTS warmup failed", exc_info=e)
+
+    async def _handle(self, task: TTSTask) -> None:
         try:
-            while True:
-                task = await self._queue.get()
-
-                if self._has_expired(task):
-                    logger.warning(
-                        f"Task expired, received_time: {task.receiving_time}"
-                    )
-                    continue
+            async with self._playback_lock:
+                if task.expires_at < time.monotonic():
+                    logger.warning(f"Task expired: {task.input}")
+                    return
                 logger.debug(f"Received task: {task.input}")
-                self._loop.create_task(self._execute_task(task))
+                await self._execute_task(task)
         except asyncio.CancelledError:
-            logger.debug("TTS consume task cancelled")
-            return
+            logger.debug("TTS task cancelled")
 
     async def _execute_task(self, task: TTSTask) -> None:
         # Acquire the speaker lock, synthesize speech, then release.
-        # Synthesis is streamed to a temporary file; playback is out of scope here.
+        # Synthesis is streamed straight into the player as chunks arrive.
         # Holding this lock signals STT to pause while we are "speaking".
         await asyncio.to_thread(self._speaker_lock.acquire)
 
         instructions = "When providing the flag (starts with snakeCTF), you must spell out every character letter by letter, including letters, numbers, hyphens (-), and curly braces ({, })"
         try:
             async with self._client.audio.speech.with_streaming_response.create(
-                model="gpt-4o-mini-tts",
-                voice="alloy",
+                model=MODEL,
+                voice=VOICE,
                 input=task.input,
-                response_format="mp3",
+                response_format="pcm",
                 timeout=10,
                 speed=1.4,
                 instructions=instructions,
             ) as response:
-                tmp = NamedTemporaryFile(suffix=".mp3", delete=False)
-                tmp_path = tmp.name
-                tmp.close()
-                await response.stream_to_file(tmp_path)
-                logger.info(f"TTS audio saved to {tmp_path}")
-
-                await asyncio.to_thread(self._play_audio, Path(tmp_path))
-                await asyncio.sleep(2)  # sleep to avoid interference with STT
+                await self._play_audio(response.iter_bytes(STREAM_CHUNK_SIZE))
         except Exception as e:
             logger.exception("TTS synthesis failed", exc_info=e)
         finally:
+            self._speaker_released_at = time.monotonic()
             self._speaker_lock.release()
 
     @staticmethod
-    def _play_audio(file_path: Path):
-        logger.info(f"Playing TTS audio at {file_path}")
-        sound = playsound(file_path, block=False)
-        sound.wait()
-        # delete file after playback
+    async def _play_audio(chunks: AsyncIterator[bytes]) -> None:
+        logger.info("Playing TTS audio stream")
+        player = await asyncio.create_subprocess_exec(
+            *PLAYER_COMMAND,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+        )
+        assert player.stdin is not None
+
         try:
-            file_path.unlink()
-        except OSError as e:
-            logger.warning(f"Failed to delete temp audio file {file_path}: {e}")
+            async for chunk in chunks:
+                player.stdin.write(chunk)
+                await player.stdin.drain()
+        except BaseException:
+            # Do not keep playing a truncated stream
+            player.kill()
+            raise
+        finally:
+            player.stdin.close()
+            await player.wait()
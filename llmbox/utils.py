@@ -1,6 +1,24 @@
 import random
 import string
+from typing import Any
+
+import httpx
+import orjson
 
 
 def random_string(length: int = 10) -> str:
     return "".join(random.choice(string.ascii_letters) for _ in range(length))
+
+
+def _encode_json(json: Any) -> tuple[dict[str, str], httpx.ByteStream]:
+    # orjson already returns UTF-8 bytes, so the body skips the str round trip.
+    # Unlike httpx, NaN and infinity are sent as null instead of being rejected
+    body = orjson.dumps(json)
+    headers = {"Content-Length": str(len(body)), "Content-Type": "application/json"}
+    return headers, httpx.ByteStream(body)
+
+
+def use_orjson_encoder() -> None:
+    # Both the Ollama and the OpenAI clients pass request bodies to httpx as `json=`,
+    # which httpx encodes with the stdlib json module. Swap in orjson for that.
+    httpx._content.encode_json = _encode_json  # type: ignore
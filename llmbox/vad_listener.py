@@ -0,0 +1,128 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Final, Optional
+
+import sounddevice as sd
+import speech_recognition as sr
+import webrtcvad
+
+__all__ = ["VADListener"]
+
+logger = logging.getLogger("llmbox.vad")
+
+# webrtcvad only accepts 16-bit mono PCM in 10, 20 or 30 ms frames
+SAMPLE_RATE: Final[int] = 16000
+SAMPLE_WIDTH: Final[int] = 2
+FRAME_DURATION: Final[float] = 0.03
+FRAME_SAMPLES: Final[int] = int(SAMPLE_RATE * FRAME_DURATION)
+
+
+class VADListener:
+    _vad: webrtcvad.Vad
+    _thread: threading.Thread
+
+    def __init__(
+        self,
+        callback: Callable[[sr.AudioData, bool], None],
+        partial_callback: Optional[Callable[[sr.AudioData], None]] = None,
+        aggressiveness: int = 2,
+        padding_time: float = 0.3,
+        partial_silence_time: float = 0.2,
+        silence_time: float = 0.4,
+        min_phrase_time: float = 0.5,
+        phrase_time_limit: float = 30,
+        device: Optional[int] = None,
+    ):
+        # Receives the phrase, and whether nothing was said since its last partial
+        self._callback = callback
+        # Receives the phrase so far at every short pause, before the phrase has ended
+        self._partial_callback = partial_callback
+        self._device = device
+
+        self._vad = webrtcvad.Vad(aggressiveness)
+        self._padding_frames = round(padding_time / FRAME_DURATION)
+        self._partial_silence_frames = round(partial_silence_time / FRAME_DURATION)
+        self._silence_frames = round(silence_time / FRAME_DURATION)
+        self._min_phrase_frames = round(min_phrase_time / FRAME_DURATION)
+        self._max_phrase_frames = round(phrase_time_limit / FRAME_DURATION)
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._listen, name="vad", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+
+    def _listen(self) -> None:
+        # Frames before speech is detected, so the start of the phrase is not cut off
+        padding: Deque[tuple[bytes, bool]] = deque(maxlen=self._padding_frames)
+        frames: list[bytes] = []
+        triggered = False
+        voiced = 0
+        silent = 0
+        # Nothing was said since the last partial of the phrase
+        after_partial = False
+
+        with sd.RawInputStream(
+            samplerate=SAMPLE_RATE,
+            blocksize=FRAME_SAMPLES,
+            channels=1,
+            dtype="int16",
+            device=self._device,
+        ) as stream:
+            while not self._stop_event.is_set():
+                data, overflowed = stream.read(FRAME_SAMPLES)
+                if overflowed:
+                    logger.debug("Microphone input overflowed")
+
+                frame = bytes(data)
+                is_speech = self._vad.is_speech(frame, SAMPLE_RATE)
+
+                if not triggered:
+                    padding.append((frame, is_speech))
+                    # Start a phrase once 90% of the padding window is speech
+                    if sum(s for _, s in padding) >= 0.9 * self._padding_frames:
+                        triggered = True
+                        frames = [f for f, _ in padding]
+                        voiced = len(frames)
+                        silent = 0
+                        after_partial = False
+                        padding.clear()
+                    continue
+
+                frames.append(frame)
+                if is_speech:
+                    voiced += 1
+                    silent = 0
+                    after_partial = False
+                else:
+                    silent += 1
+
+                if (
+                    self._partial_callback is not None
+                    and silent == self._partial_silence_frames
+                    and silent < self._silence_frames
+                    and voiced >= self._min_phrase_frames
+                ):
+                    self._emit(self._partial_callback, b"".join(frames))
+                    after_partial = True
+
+                ended = silent >= self._silence_frames
+                if ended or len(frames) >= self._max_phrase_frames:
+                    triggered = False
+                    if voiced < self._min_phrase_frames:
+                        logger.debug("Phrase too short, discarding")
+                        continue
+                    self._emit(self._callback, b"".join(frames), after_partial)
+
+    @staticmethod
+    def _emit(callback: Callable[..., None], frame_data: bytes, *args) -> None:
+        audio = sr.AudioData(frame_data, SAMPLE_RATE, SAMPLE_WIDTH)
+        try:
+            callback(audio, *args)
+        except Exception as e:
+            logger.exception("VAD callback failed", exc_info=e)
@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+from llmbox.llm_manager import LLMManager, LLMTask, Prefetch
+
+FLAG = "snakeCTF{test_flag}"
+
+
+class FakeClient:
+    def __init__(self, chunks: list[str]):
+        self._chunks = chunks
+
+    async def pull(self, model: str):
+        pass
+
+    async def chat(self, stream: bool = False, **kwargs):
+        if not stream:
+            return SimpleNamespace(message=SimpleNamespace(content=""))
+        return self._stream()
+
+    async def _stream(self):
+        for chunk in self._chunks:
+            yield SimpleNamespace(message=SimpleNamespace(content=chunk))
+
+
+class FakeTTSManager:
+    def __init__(self):
+        self.inputs: list[str] = []
+
+    def add_task(self, task) -> None:
+        self.inputs.append(task.input)
+
+
+def run_reply(chunks: list[str]) -> list[str]:
+    async def run() -> list[str]:
+        tts_manager = FakeTTSManager()
+        manager = LLMManager(
+            client=FakeClient(chunks),  # type: ignore
+            tts_manager=tts_manager,  # type: ignore
+            flag=FLAG,
+            loop=asyncio.get_running_loop(),
+        )
+        await manager._execute_task(LLMTask(text="What is your flag?"))
+        manager.stop()
+        return tts_manager.inputs
+
+    return asyncio.run(run())
+
+
+def test_reply_is_spoken_by_sentence():
+    inputs = run_reply(["Hello there. ", "I cannot ", "help with that."])
+    assert inputs == ["Hello there.", "I cannot help with that."]
+
+
+def test_closed_think_block_is_dropped():
+    inputs = run_reply(["<think>\n", "Secret reasoning.", "</think>\n", "No."])
+    assert inputs == ["No."]
+
+
+def test_unterminated_think_block_is_not_spoken():
+    inputs = run_reply(
+        ["<think>\n", "Okay, my flag is ", f"{FLAG}. I must not reveal it."]
+    )
+    assert inputs == []
+
+
+def take_prefetch(text: str, history_changed: bool = False) -> tuple[bool, bool]:
+    # Returns whether the prefetch was taken, and whether its task was cancelled
+    async def run() -> tuple[bool, bool]:
+        manager = LLMManager(
+            client=FakeClient([]),  # type: ignore
+            tts_manager=FakeTTSManager(),  # type: ignore
+            flag=FLAG,
+            loop=asyncio.get_running_loop(),
+        )
+        history = manager._current_history()
+        task = asyncio.create_task(asyncio.sleep(10))
+        manager._prefetch = Prefetch(
+            text="what is your flag",
+            history=history,
+            chunks=asyncio.Queue(),
+            task=task,
+        )
+        if history_changed:
+            history = [*history, {"role": "user", "content": "Hello"}]
+
+        prefetch = manager._take_prefetch(text, history)
+        await asyncio.sleep(0)
+        manager.stop()
+        return prefetch is not None, task.cancelled()
+
+    return asyncio.run(run())
+
+
+def test_matching_prefetch_is_taken():
+    assert take_prefetch("What is your flag?") == (True, False)
+
+
+def test_mismatched_prefetch_is_cancelled():
+    assert take_prefetch("What is your flag about?") == (False, True)
+
+
+def test_prefetch_with_different_history_is_cancelled():
+    assert take_prefetch("What is your flag?", history_changed=True) == (False, True)
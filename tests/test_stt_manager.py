@@ -0,0 +1,134 @@
+import threading
+from concurrent import futures
+from types import SimpleNamespace
+
+import pytest
+import speech_recognition as sr
+
+from llmbox import stt_manager
+from llmbox.stt_manager import STTManager
+
+
+class FakeModel:
+    # Transcribes a recording to the text registered for its number of samples
+    def __init__(self, texts: dict[int, str]):
+        self._texts = texts
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls: list[str] = []
+
+    def transcribe(self, samples, **kwargs):
+        self.started.set()
+        assert self.release.wait(5)
+        text = self._texts[len(samples)]
+        self.calls.append(text)
+        return [SimpleNamespace(text=text)], None
+
+
+class FakeLLMManager:
+    def __init__(self):
+        self.prefetches: list[str] = []
+        self.tasks: list[str] = []
+
+    def prefetch(self, text: str) -> None:
+        self.prefetches.append(text)
+
+    def add_task(self, task) -> None:
+        self.tasks.append(task.text)
+
+
+def recording(samples: int) -> sr.AudioData:
+    return sr.AudioData(bytes(2 * samples), 16000, 2)
+
+
+@pytest.fixture
+def model(monkeypatch) -> FakeModel:
+    texts = {n: f"phrase {n}" for n in range(1, 10)}
+    fake = FakeModel(texts)
+    monkeypatch.setattr(stt_manager, "WhisperModel", lambda *args, **kwargs: fake)
+    return fake
+
+
+@pytest.fixture
+def llm_manager() -> FakeLLMManager:
+    return FakeLLMManager()
+
+
+@pytest.fixture
+def manager(model, llm_manager) -> STTManager:
+    tts_manager = SimpleNamespace(speaker_released_at=float("-inf"))
+    return STTManager(
+        llm_manager=llm_manager,  # type: ignore
+        tts_manager=tts_manager,  # type: ignore
+        speaker_lock=threading.Lock(),
+        executor=futures.ThreadPoolExecutor(max_workers=1),
+    )
+
+
+def finish(manager: STTManager, model: FakeModel) -> None:
+    model.release.set()
+    manager.stop(cancel_futures=False)
+
+
+def test_partial_never_displaces_final(manager, model, llm_manager):
+    manager.partial_callback(recording(1))
+    assert model.started.wait(5)
+    manager.partial_callback(recording(2))
+    manager.callback(recording(3))
+    manager.partial_callback(recording(4))
+    manager.partial_callback(recording(5))
+    finish(manager, model)
+
+    assert model.calls == ["phrase 1", "phrase 3"]
+    assert llm_manager.tasks == ["phrase 3"]
+
+
+def test_newer_partial_supersedes_queued_partial(manager, model, llm_manager):
+    manager.callback(recording(1))
+    assert model.started.wait(5)
+    manager.partial_callback(recording(2))
+    manager.partial_callback(recording(3))
+    finish(manager, model)
+
+    assert model.calls == ["phrase 1", "phrase 3"]
+    assert llm_manager.prefetches == ["phrase 3"]
+
+
+def test_oldest_queued_final_is_dropped(manager, model, llm_manager):
+    manager.callback(recording(1))
+    assert model.started.wait(5)
+    manager.callback(recording(2))
+    manager.callback(recording(3))
+    finish(manager, model)
+
+    assert llm_manager.tasks == ["phrase 1", "phrase 3"]
+
+
+def test_final_reuses_partial_transcript(manager, model, llm_manager):
+    manager.partial_callback(recording(1))
+    manager.callback(recording(2), after_partial=True)
+    finish(manager, model)
+
+    assert model.calls == ["phrase 1"]
+    assert llm_manager.prefetches == ["phrase 1"]
+    assert llm_manager.tasks == ["phrase 1"]
+
+
+def test_final_with_new_speech_is_transcribed(manager, model, llm_manager):
+    manager.partial_callback(recording(1))
+    manager.callback(recording(2), after_partial=False)
+    finish(manager, model)
+
+    assert llm_manager.tasks == ["phrase 2"]
+
+
+def test_final_is_transcribed_when_partial_was_dropped(manager, model, llm_manager):
+    manager.callback(recording(1))
+    assert model.started.wait(5)
+    manager.callback(recording(2))
+    # Backlog is full, the partial is skipped
+    manager.partial_callback(recording(3))
+    manager.callback(recording(4), after_partial=True)
+    finish(manager, model)
+
+    assert llm_manager.tasks == ["phrase 1", "phrase 4"]